@@ -3,17 +3,155 @@ import json
 import logging
 import os
 import sys
-from datetime import date
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timezone
+from pathlib import Path
 
 import click
 import pandas as pd
 import requests
 from dotenv import find_dotenv, load_dotenv
 from geopy.geocoders import GoogleV3
+from requests.adapters import HTTPAdapter
+from requests_cache import CachedSession
 from tqdm import tqdm
+from urllib3.util.retry import Retry
 
+# number of concurrent requests to the Dark Sky API
+MAX_WORKERS = 8
 
-def get_weather(latitude, longitude, obs_date, units='auto'):
+_session = None
+_session_lock = threading.Lock()
+
+# minimum interval in seconds between the start of two requests
+MIN_REQUEST_INTERVAL = 0.1
+# Dark Sky free tier limit of calls per day
+MAX_DAILY_CALLS = 1000
+
+_throttle_lock = threading.Lock()
+_last_request = 0.0
+
+# calls made to the Dark Sky API per UTC day, see `load_daily_calls`
+_daily_calls = {}
+_calls_lock = threading.Lock()
+
+
+def _throttle():
+    """ Blocks the calling thread until at least `MIN_REQUEST_INTERVAL`
+        seconds have passed since the previous request started, so the
+        concurrent workers don't flood the API.
+    """
+    global _last_request
+    with _throttle_lock:
+        wait = _last_request + MIN_REQUEST_INTERVAL - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        _last_request = time.monotonic()
+
+
+def _daily_calls_fn():
+    """ Returns the path of the JSON file with the daily count of API calls.
+    """
+    return os.path.join(project_dir, 'data', 'raw', '.darksky_calls.json')
+
+
+def load_daily_calls():
+    """ Loads the number of calls made to the Dark Sky API today from
+        ../../data/raw/.darksky_calls.json, so the daily limit holds across
+        runs, locations and years.
+    """
+    today = datetime.now(timezone.utc).date().isoformat()
+    calls = {}
+    if os.path.exists(_daily_calls_fn()):
+        with open(_daily_calls_fn(), 'r') as fp:
+            calls = json.load(fp)
+    with _calls_lock:
+        _daily_calls.clear()
+        _daily_calls[today] = calls.get(today, 0)
+
+
+def save_daily_calls():
+    """ Saves the number of calls made to the Dark Sky API today to
+        ../../data/raw/.darksky_calls.json.
+    """
+    with _calls_lock:
+        calls = dict(_daily_calls)
+    with open(_daily_calls_fn(), 'w') as fp:
+        json.dump(calls, fp)
+
+
+def _reserve_call():
+    """ Counts a call to the Dark Sky API against today's limit.
+
+        :returns bool: False when the daily limit of calls was reached
+    """
+    today = datetime.now(timezone.utc).date().isoformat()
+    with _calls_lock:
+        calls = _daily_calls.get(today, 0)
+        if calls >= MAX_DAILY_CALLS:
+            return False
+        _daily_calls[today] = calls + 1
+        return True
+
+
+class _CountingRetry(Retry):
+    """ Retry policy that counts every retried request against today's limit
+        of calls, since each retry reaches the Dark Sky API again.
+    """
+
+    def increment(self, *args, **kwargs):
+        # raises when the retries are exhausted, no request is sent then
+        retry = super().increment(*args, **kwargs)
+        today = datetime.now(timezone.utc).date().isoformat()
+        with _calls_lock:
+            _daily_calls[today] = _daily_calls.get(today, 0) + 1
+        return retry
+
+
+def get_session():
+    """ Returns the HTTP session for the Dark Sky API, creating it on first
+        use. It reuses the connection between requests (keep-alive) and
+        caches the responses at ../../data/raw/.http_cache.sqlite so re-runs
+        don't hit the network for fetched days. The cached URLs hold the API
+        key, keep the file private.
+
+        :returns: HTTP session with a SQLite response cache
+        :rtype: requests_cache.CachedSession
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            cache_name = os.path.join(project_dir,
+                                      'data', 'raw', '.http_cache')
+            retries = _CountingRetry(total=3,
+                                     backoff_factor=0.5,
+                                     status_forcelist=[429, 500, 502,
+                                                       503, 504])
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=MAX_WORKERS,
+                                  max_retries=retries)
+            _session = CachedSession(cache_name=cache_name,
+                                     backend='sqlite',
+                                     expire_after=None,
+                                     allowable_methods=('GET',))
+            _session.mount('https://', adapter)
+    return _session
+
+
+def _is_cached(session, url):
+    """ Checks if the response for the url is in the session cache.
+
+        :param session: HTTP session used for the request
+        :param str url: Request url
+        :returns bool: True when the request won't hit the network
+    """
+    cache = getattr(session, 'cache', None)
+    return cache is not None and cache.contains(url=url)
+
+
+def get_weather(latitude, longitude, obs_date, units='auto', session=None):
     """ Takes a location coordinates and a date and returns the weather conditions.
 
         :param float latitude: Latitude
@@ -22,7 +160,11 @@ def get_weather(latitude, longitude, obs_date, units='auto'):
         :type obs_date: datetime.date
         :param units: Observation units. Default auto.
                       Possible values: auto, ca, uk2, us, si
-        :returns: JSON object with the daily weather conditions or False
+        :param session: HTTP session used for the request.
+                        Default `get_session()`.
+        :type session: requests.Session
+        :returns: Raw JSON bytes and parsed JSON object with the daily weather
+                  conditions or None, None
     """
     api_forecast_io = 'https://api.darksky.net/forecast/{}/{},{},{}?units={}'
     obs_date = '{}T00:00:00'.format(obs_date)
@@ -31,12 +173,108 @@ def get_weather(latitude, longitude, obs_date, units='auto'):
                                         longitude,
                                         obs_date,
                                         units)
-    response = requests.get(lookup_url)
+    if session is None:
+        session = get_session()
+    # only count and space out the requests that actually go to the network
+    if not _is_cached(session, lookup_url):
+        if not _reserve_call():
+            logging.getLogger(__name__).error(
+                "daily limit of {0:d} API calls reached"
+                .format(MAX_DAILY_CALLS))
+            return None, None
+        _throttle()
+    try:
+        response = session.get(lookup_url, timeout=(3.05, 30))
+    except requests.RequestException:
+        # retries exhausted, timeouts and connection errors
+        return None, None
 
     if response:
-        return response.json()
+        return response.content, response.json()
     else:
-        return
+        return None, None
+
+
+def get_coordinates(location):
+    """ Takes a location name and returns its coordinates, using a JSON cache
+        at ../../data/raw/.geocache.json to avoid repeated geocoding requests.
+
+        :param str location: Name of the location
+        :returns: Latitude and longitude of the location
+        :rtype: list
+    """
+    geocache_fn = os.path.join(project_dir, 'data', 'raw', '.geocache.json')
+    if os.path.exists(geocache_fn):
+        with open(geocache_fn, 'r') as fp:
+            geocache = json.load(fp)
+    else:
+        geocache = {}
+
+    key = location.strip().lower()
+    if key not in geocache:
+        # use `geopy` to get the coordinates of the location.
+        geocoder = GoogleV3(api_key=os.environ.get('WTD_MAPS_KEY'))
+        geocode = geocoder.geocode(location)
+        geocache[key] = [geocode.latitude, geocode.longitude]
+        with open(geocache_fn, 'w') as fp:
+            json.dump(geocache, fp)
+
+    return geocache[key]
+
+
+def _fetch_days(pending, total, latitude, longitude, logger):
+    """ Fetches the pending days in parallel and writes them as JSON files.
+
+        :param list pending: Day of year, date and file name of each day
+        :param int total: Number of days in the year
+        :param float latitude: Latitude
+        :param float longitude: Longitude
+        :param logging.Logger logger: Logger of `main`
+    """
+    with tqdm(total=total, initial=total - len(pending)) as pbar, \
+            ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # get the json request for the weather observations for each day
+        futures = {}
+        for doy, obs_date, obs_fn in pending:
+            future = executor.submit(get_weather,
+                                     latitude, longitude, obs_date)
+            futures[future] = (doy, obs_fn)
+
+        for future in as_completed(futures):
+            doy, obs_fn = futures[future]
+            raw, response = future.result()
+            if raw:
+                # check that response json had the `daily` key
+                try:
+                    resp_time = response['daily']['data'][0]['time']
+                    resp_date = date.fromtimestamp(resp_time)
+                    resp_doy = resp_date.timetuple().tm_yday
+                except KeyError:
+                    logger.error("response JSON doesn't have `daily` key")
+                    click.echo(response)
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    sys.exit(0)
+                # check day of year in the response and assert is same in
+                # request
+                try:
+                    assert resp_doy == doy, \
+                        "Day of year should be equal in request and response."
+                except AssertionError:
+                    logger.warning("request day of year ({0:d}) diferent from "
+                                   "in response ({1:d})"
+                                   .format(doy, resp_doy))
+                else:
+                    logger.info("request day of year same as in response")
+
+                # write the json file as received, without re-encoding it
+                with open(obs_fn, 'wb', buffering=64 * 1024) as fp:
+                    fp.write(raw)
+            else:
+                logger.error("doy:{0:d} can\'t fetch data from API"
+                             .format(doy))
+                executor.shutdown(wait=False, cancel_futures=True)
+                return
+            pbar.update(1)
 
 
 @click.command()
@@ -55,54 +293,34 @@ def main(location, year):
     logger.info("getting json data for every day of the year")
 
     # create folder path for saving the JSON data
-    output_folder = os.path.join(project_dir, 'data', 'raw', location, str(year))
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
+    output_folder = Path(project_dir, 'data', 'raw', location, str(year))
+    output_folder.mkdir(parents=True, exist_ok=True)
+    existing = {p.name for p in output_folder.iterdir()}
 
-    # use `geopy` to get the coordinates of the location.
-    geocode = GoogleV3(api_key=os.environ.get('WTD_MAPS_KEY')).geocode(location)
-    latitude = geocode.latitude
-    longitude = geocode.longitude
+    latitude, longitude = get_coordinates(location)
 
     obs_dates = [d.date() for d in pd.date_range(start=date(year, 1, 1),
                                                  end=date(year, 12, 31),
                                                  normalize=True)]
+
+    # list the days of the year that weren't fetched yet
+    pending = []
+    for obs_date in obs_dates:
+        doy = obs_date.timetuple().tm_yday
+        obs_name = f'{doy}.json'
+        obs_fn = output_folder / obs_name
+
+        if obs_name not in existing:
+            pending.append((doy, obs_date, obs_fn))
+        else:
+            logger.info("file {0} already exists, skipping".format(obs_fn))
+
     click.echo("\nFetching the data from Dark Sky API:")
-    with tqdm(total=len(obs_dates)) as pbar:
-        for obs_date in obs_dates:
-            doy = obs_date.timetuple().tm_yday
-            obs_fn = os.path.normpath(os.path.join(output_folder, str(doy) + '.json'))
-
-            if not os.path.exists(obs_fn):
-                # get the json request for the weather observations for the day
-                response = get_weather(latitude, longitude, obs_date)
-                if response:
-                    # check that response json had the `daily` key
-                    try:
-                        resp_date = date.fromtimestamp(response['daily']['data'][0]['time'])
-                        resp_doy = resp_date.timetuple().tm_yday
-                    except KeyError:
-                        logger.error("response JSON doesn't have `daily` key")
-                        click.echo(response)
-                        sys.exit(0)
-                    # check day of year in the response and assert is same in request
-                    try:
-                        assert resp_doy == doy, "Day of year should be equal in request and response."
-                    except AssertionError:
-                        logger.warning("request day of year ({0:d}) diferent from in response ({1:d})"
-                                       .format(doy, resp_doy))
-                    else:
-                        logger.info("request day of year same as in response")
-
-                    # write json file
-                    with open(obs_fn, 'w') as fp:
-                        json.dump(response, fp)
-                else:
-                    logger.error("doy:{0:d} can\'t fetch data from API".format(doy))
-                    return
-            else:
-                logger.info("file {0} already exists, skipping".format(obs_fn))
-            pbar.update(1)
+    load_daily_calls()
+    try:
+        _fetch_days(pending, len(obs_dates), latitude, longitude, logger)
+    finally:
+        save_daily_calls()
 
 
 if __name__ == '__main__':
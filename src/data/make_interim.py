@@ -1,46 +1,91 @@
 # -*- coding: utf-8 -*-
-import glob
-import json
 import logging
 import os
 import re
+from concurrent.futures import ProcessPoolExecutor
 
 import click
+import ijson
 import pandas as pd
 import pandas.io.json as pd_json
+import pyarrow as pa
 from dotenv import find_dotenv, load_dotenv
+from pyarrow import csv as pacsv
 from tqdm import tqdm
 
+# matches the names of the timestamp columns
+_TIME_RE = re.compile(r'(.+|)[tT]ime')
 
-def get_observations(obs_folder, key):
+
+def _parse_observation(fn_key):
+    """ Takes a JSON file name and target key and returns a pandas dataframe
+        with the observations in the file and the time zone of the data.
+
+        :param tuple fn_key: JSON file name and dictionary key;
+        :returns pandas.DataFrame: Weather observations;
+        :returns str: Time zone of the local.
+    """
+    fn, key = fn_key
+    with open(fn, 'rb') as fp:
+        # stream only the needed values instead of parsing the whole response
+        time_zone = next(ijson.items(fp, 'timezone'), None)
+        if time_zone is None:
+            raise ValueError("{0} doesn't have `timezone` key".format(fn))
+        fp.seek(0)
+        key_data = list(ijson.items(fp, key + '.data.item', use_float=True))
+
+    # import data to pandas, the records are flat so only normalize nested ones
+    if key_data and any(isinstance(v, dict) for v in key_data[0].values()):
+        return pd_json.json_normalize(key_data), time_zone
+    return pd.DataFrame.from_records(key_data), time_zone
+
+
+def get_observations(obs_folder, key, executor):
     """ Takes the path and target key and returns a pandas dataframe with
         the observations for a full year and the time zone of the data.
 
         :param str obs_folder: Folder path for the yearly observations;
         :param str key: Dictionary key;
+        :param executor: Pool parsing the JSON files;
+        :type executor: concurrent.futures.ProcessPoolExecutor
         :returns pandas.DataFrame: Weather observations;
         :returns str: Time zone of the local.
     """
-    year_pattern = os.path.join(obs_folder, '*.json')
-    year_files = glob.glob(year_pattern)
+    # skip hidden files, as glob did, e.g. macOS `._12.json` metadata
+    year_files = [e.path for e in os.scandir(obs_folder)
+                  if e.name.endswith('.json') and not e.name.startswith('.')]
 
-    # read observation json files
-    observations = []
-    for fn in year_files:
-        with open(fn, 'r') as fp:
-            raw_obs = fp.read()
-            json_obs = json.loads(raw_obs)
+    # read observation json files in parallel
+    parsed = list(executor.map(_parse_observation,
+                               [(fn, key) for fn in year_files],
+                               chunksize=16))
 
-            # import data to pandas
-            key_data = json_obs[key]['data']
-            observations.append(pd_json.json_normalize(key_data))
-
-    observations = pd.concat(observations)
-    time_zone = json_obs['timezone']
+    observations = pd.concat([obs for obs, _ in parsed])
+    time_zone = parsed[-1][1]
 
     return observations, time_zone
 
 
+def set_dtypes(observations):
+    """ Shrinks the memory used by the observations, storing the text columns
+        as categories and downcasting the float columns. Timestamp columns are
+        kept as they are, since float32 can't hold them exactly.
+
+        :param pandas.DataFrame observations: All the local observations;
+        :returns pandas.DataFrame: Weather observations.
+    """
+    for column in ['icon', 'summary', 'precipType']:
+        if column in observations.columns:
+            observations[column] = observations[column].astype('category')
+
+    for column in observations.select_dtypes('float64').columns:
+        if not _TIME_RE.fullmatch(str(column)):
+            observations[column] = pd.to_numeric(observations[column],
+                                                 downcast='float')
+
+    return observations
+
+
 def get_datetime(observations, time_zone):
     """ Due to an old outstanding bug in Pandas there are some problems
         concatenating dataframes with datetime when some columns are
@@ -53,15 +98,11 @@ def get_datetime(observations, time_zone):
     """
 
     # transform all timestamps into datetime
-    columns = []
-    regex_expression = "(.+|)[tT]ime"
-    for column in observations.columns:
-        columns.append(str(column))
-    time_columns = [m.group(0) for l in columns for m in [re.fullmatch(regex_expression, l)] if m]
+    time_columns = [c for c in observations.columns
+                    if _TIME_RE.fullmatch(str(c))]
     for column in time_columns:
-        observations[column] = pd.to_datetime(observations[column],
-                                              unit='s',
-                                              infer_datetime_format=True).dt.tz_localize('UTC').dt.tz_convert(time_zone)
+        timestamps = pd.to_datetime(observations[column], unit='s', utc=True)
+        observations[column] = timestamps.dt.tz_convert(time_zone)
 
     # set the dataframe index to the time column
     observations.set_index('time', inplace=True)
@@ -70,6 +111,52 @@ def get_datetime(observations, time_zone):
     return observations
 
 
+def make_location(location_path, output_folder, executor):
+    """ Parses all the yearly observations of a location and writes them as
+        interim CSV and PARQUET data.
+
+        :param str location_path: Folder path for the location observations;
+        :param str output_folder: Folder path for the interim data;
+        :param executor: Pool parsing the JSON files;
+        :type executor: concurrent.futures.ProcessPoolExecutor
+    """
+    _, location = os.path.split(location_path)
+    click.echo("\nParsing " + location + ":")
+    # year folders are the directories named after a 4-digit year
+    years = sorted(e.path for e in os.scandir(location_path)
+                   if e.is_dir() and not e.name.startswith('.')
+                   and e.name[-4:].isdigit())
+
+    frames = []
+    with tqdm(total=len(years)) as pbar:
+        for year_path in years:
+            pbar.set_postfix({'year': year_path[-4:]})
+            observation, time_zone = get_observations(year_path, 'daily',
+                                                      executor)
+            frames.append(observation)
+            pbar.update(1)
+    observations = pd.concat(frames, ignore_index=True)
+    observations = set_dtypes(observations)
+
+    # set the datetime
+    observations = get_datetime(observations, time_zone)
+
+    # ERROR: location tem de ser apenas o sítio
+    # write CSV file
+    output_csv_file = os.path.join(output_folder, location + "_daily.csv")
+    table = pa.Table.from_pandas(observations.reset_index())
+    pacsv.write_csv(table, output_csv_file,
+                    write_options=pacsv.WriteOptions(batch_size=8192))
+
+    # write zstd compressed parquet file
+    output_parquet_file = os.path.join(output_folder,
+                                       location + "_daily.parquet")
+    observations.to_parquet(output_parquet_file,
+                            engine='pyarrow',
+                            compression='zstd',
+                            compression_level=3)
+
+
 @click.command()
 @click.argument('input_filepath', default='data/raw', type=click.Path(exists=True))
 @click.argument('output_filepath', default='data/interim', type=click.Path(exists=True))
@@ -77,45 +164,24 @@ def main(input_filepath, output_filepath):
     """ Runs data processing scripts to turn raw daily data from
         `data/raw/{location}/{year}/*.json`
         into interim CSV data saved in `data/interim/{location}.csv`
-        and into interim XZ zipped PICKLE data saved in `data/interim/{location}.xz`.
+        and into interim zstd compressed PARQUET data saved in
+        `data/interim/{location}.parquet`.
     """
     logger = logging.getLogger(__name__)
-    logger.info('making interim CSV and pickled data set from daily raw data')
+    logger.info('making interim CSV and parquet data set from daily raw data')
 
     input_folder = os.path.normpath(os.path.join(project_dir, input_filepath))
     output_folder = os.path.normpath(os.path.join(project_dir, output_filepath))
 
     # get all the files/directories under `input_filepath` and filter in directories
-    locations = glob.glob(os.path.join(input_folder, '*'))
-    locations = filter(os.path.isdir, locations)
-
-    for location_path in locations:
-        _, location = os.path.split(location_path)
-        click.echo("\nParsing " + location + ":")
-        year_regex = re.compile(r'(.+\d+)')
-        years = glob.glob(os.path.join(location_path, '*'))
-        years = filter(os.path.isdir, years)
-        years = sorted(list(filter(year_regex.search, years)))
-
-        observations = pd.DataFrame()
-        with tqdm(total=len(years)) as pbar:
-            for year_path in years:
-                pbar.set_postfix({'year': year_path[-4:]})
-                observation, time_zone = get_observations(year_path, 'daily')
-                observations = pd.concat([observations, observation])
-                pbar.update(1)
-
-        # set the datetime
-        observations = get_datetime(observations, time_zone)
-
-        # ERROR: location tem de ser apenas o sítio
-        # write CSV file
-        output_csv_file = os.path.join(output_folder, location + "_daily.csv")
-        observations.to_csv(output_csv_file)
-
-        # Write xz compressed pickle file
-        output_pkl_file = os.path.join(output_folder, location + "_daily.xz")
-        observations.to_pickle(output_pkl_file)        
+    # skipping hidden ones, e.g. `.ipynb_checkpoints`
+    locations = [e.path for e in os.scandir(input_folder)
+                 if e.is_dir() and not e.name.startswith('.')]
+
+    # share one pool of JSON parsing processes between all the years
+    with ProcessPoolExecutor() as executor:
+        for location_path in locations:
+            make_location(location_path, output_folder, executor)
 
 
 if __name__ == '__main__':